@@ -1,7 +1,7 @@
 import sys
 import configparser
 import shutil
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlite3 import connect
 from os import mkdir
 from os.path import exists
@@ -12,7 +12,21 @@ from nxc.paths import WORKSPACE_DIR
 
 
 def create_db_engine(db_path):
-    return create_engine(f"sqlite:///{db_path}", isolation_level="AUTOCOMMIT", future=True)
+    db_engine = create_engine(f"sqlite:///{db_path}", isolation_level="AUTOCOMMIT", future=True)
+
+    @event.listens_for(db_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL journaling with relaxed syncing keeps write-heavy scans from fsyncing on
+        # every row and lets readers run while another connection is writing
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-65536")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.close()
+
+    return db_engine
 
 
 def open_config(config_path):
@@ -419,10 +419,11 @@ class smb(connection):
                 self.check_if_admin()
 
             self.logger.debug(f"Adding credential: {domain}/{self.username}:{self.password}")
-            self.db.add_credential("plaintext", domain, self.username, self.password)
-            user_id = self.db.get_credential("plaintext", domain, self.username, self.password)
-            host_id = self.db.get_hosts(self.host)[0].id
-            self.db.add_loggedin_relation(user_id, host_id)
+            with self.db.batch():
+                self.db.add_credential("plaintext", domain, self.username, self.password)
+                user_id = self.db.get_credential("plaintext", domain, self.username, self.password)
+                host_id = self.db.get_hosts(self.host)[0].id
+                self.db.add_loggedin_relation(user_id, host_id)
 
             out = f"{domain}\\{self.username}:{process_secret(self.password)} {self.mark_guest()}{self.mark_pwned()}"
             self.logger.success(out)
@@ -483,10 +484,11 @@ class smb(connection):
             if "Unix" not in self.server_os:
                 self.check_if_admin()
 
-            self.db.add_credential("hash", domain, self.username, self.hash)
-            user_id = self.db.get_credential("hash", domain, self.username, self.hash)
-            host_id = self.db.get_hosts(self.host)[0].id
-            self.db.add_loggedin_relation(user_id, host_id)
+            with self.db.batch():
+                self.db.add_credential("hash", domain, self.username, self.hash)
+                user_id = self.db.get_credential("hash", domain, self.username, self.hash)
+                host_id = self.db.get_hosts(self.host)[0].id
+                self.db.add_loggedin_relation(user_id, host_id)
 
             out = f"{domain}\\{self.username}:{process_secret(self.hash)} {self.mark_guest()}{self.mark_pwned()}"
             self.logger.success(out)
@@ -775,6 +777,8 @@ class smb(connection):
     def shares(self):
         temp_dir = ntpath.normpath("\\" + gen_random_string())
         permissions = []
+        db_shares = []
+        user_id = None
 
         try:
             self.logger.debug(f"domain: {self.domain}")
@@ -838,13 +842,24 @@ class smb(connection):
 
             permissions.append(share_info)
 
-            if share_name != "IPC$":
-                try:
-                    # TODO: check if this already exists in DB before adding
-                    self.db.add_share(self.hostname, user_id, share_name, share_remark, read, write)
-                except Exception as e:
-                    error = get_error_string(e)
-                    self.logger.debug(f"Error adding share: {error}")
+            if share_name != "IPC$" and user_id is not None:
+                db_shares.append(
+                    {
+                        "hostid": self.hostname,
+                        "userid": user_id,
+                        "name": share_name,
+                        "remark": share_remark,
+                        "read": read,
+                        "write": write,
+                    }
+                )
+
+        try:
+            # one INSERT for the whole enumeration instead of a round trip per share
+            self.db.add_shares(db_shares)
+        except Exception as e:
+            error = get_error_string(e)
+            self.logger.debug(f"Error adding shares: {error}")
 
         self.logger.display("Enumerated shares")
         self.logger.highlight(f"{'Share':<15} {'Permissions':<15} {'Remark'}")
@@ -1,15 +1,12 @@
 import base64
 import warnings
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
 
-from sqlalchemy import MetaData, func, Table, select, delete
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, MetaData, Table, Text, UniqueConstraint, func, inspect, select, delete, text
 from sqlalchemy.dialects.sqlite import Insert  # used for upsert
-from sqlalchemy.exc import (
-    IllegalStateChangeError,
-    NoInspectionAvailable,
-    NoSuchTableError,
-)
+from sqlalchemy.exc import IllegalStateChangeError
 from sqlalchemy.exc import SAWarning
 from sqlalchemy.orm import sessionmaker, scoped_session
 
@@ -20,6 +17,126 @@ from typing import Optional
 # if there is an issue with SQLAlchemy and a connection cannot be cleaned up properly it spews out annoying warnings
 warnings.filterwarnings("ignore", category=SAWarning)
 
+# stamped into PRAGMA user_version by db_schema and checked in reflect_tables; bump it
+# whenever db_schema changes shape (tables, indexes, constraints, collations) so
+# databases created by older versions fail with the friendly schema-mismatch message
+# instead of erroring mid-scan
+DB_SCHEMA_VERSION = 1
+
+# the schema is fixed and owned by db_schema below, so the tables are declared
+# statically instead of being reflected with PRAGMA round trips at every startup
+metadata = MetaData()
+HostsTable = Table(
+    "hosts",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("ip", Text, unique=True),
+    Column("hostname", Text(collation="NOCASE")),
+    Column("domain", Text(collation="NOCASE")),
+    Column("os", Text),
+    Column("dc", Boolean),
+    Column("smbv1", Boolean),
+    Column("signing", Boolean),
+    Column("spooler", Boolean),
+    Column("zerologon", Boolean),
+    Column("petitpotam", Boolean),
+)
+ConfChecksTable = Table(
+    "conf_checks",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("name", Text, unique=True),
+    Column("description", Text),
+)
+ConfChecksResultsTable = Table(
+    "conf_checks_results",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("host_id", Integer, ForeignKey("hosts.id")),
+    Column("check_id", Integer, ForeignKey("conf_checks.id")),
+    Column("secure", Boolean),
+    Column("reasons", Text),
+    UniqueConstraint("host_id", "check_id"),
+)
+UsersTable = Table(
+    "users",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("domain", Text(collation="NOCASE")),
+    Column("username", Text(collation="NOCASE")),
+    Column("password", Text),
+    Column("credtype", Text(collation="NOCASE")),
+    Column("pillaged_from_hostid", Integer, ForeignKey("hosts.id")),
+)
+Index("ix_users_domain_username_credtype", UsersTable.c.domain, UsersTable.c.username, UsersTable.c.credtype, unique=True)
+GroupsTable = Table(
+    "groups",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("domain", Text(collation="NOCASE")),
+    Column("name", Text(collation="NOCASE")),
+    Column("rid", Text),
+    Column("member_count_ad", Integer),
+    Column("last_query_time", Text),
+)
+Index("ix_groups_domain_name", GroupsTable.c.domain, GroupsTable.c.name, unique=True)
+AdminRelationsTable = Table(
+    "admin_relations",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("userid", Integer, ForeignKey("users.id")),
+    Column("hostid", Integer, ForeignKey("hosts.id")),
+    UniqueConstraint("userid", "hostid"),
+)
+GroupRelationsTable = Table(
+    "group_relations",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("userid", Integer, ForeignKey("users.id")),
+    Column("groupid", Integer, ForeignKey("groups.id")),
+    UniqueConstraint("userid", "groupid"),
+)
+SharesTable = Table(
+    "shares",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("hostid", Text),
+    Column("userid", Integer, ForeignKey("users.id")),
+    Column("name", Text),
+    Column("remark", Text),
+    Column("read", Boolean),
+    Column("write", Boolean),
+    UniqueConstraint("hostid", "userid", "name"),
+    Index("ix_shares_hostid_name", "hostid", "name"),
+)
+LoggedinRelationsTable = Table(
+    "loggedin_relations",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("userid", Integer, ForeignKey("users.id")),
+    Column("hostid", Integer, ForeignKey("hosts.id")),
+)
+DpapiSecrets = Table(
+    "dpapi_secrets",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("host", Text),
+    Column("dpapi_type", Text(collation="NOCASE")),
+    Column("windows_user", Text),
+    Column("username", Text),
+    Column("password", Text),
+    Column("url", Text(collation="NOCASE")),
+    UniqueConstraint("host", "dpapi_type", "windows_user", "username", "password", "url"),
+)
+DpapiBackupkey = Table(
+    "dpapi_backupkey",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("domain", Text(collation="NOCASE")),
+    Column("pvk", Text),
+    UniqueConstraint("domain"),
+)
+
 
 class database:
     def __init__(self, db_engine):
@@ -38,22 +155,33 @@ class database:
         self.db_engine = db_engine
         self.db_path = self.db_engine.url.database
         self.protocol = Path(self.db_path).stem.upper()
-        self.metadata = MetaData()
+        self.metadata = metadata
         self.reflect_tables()
         session_factory = sessionmaker(bind=self.db_engine, expire_on_commit=True)
 
-        Session = scoped_session(session_factory)
-        # this is still named "conn" when it is the session object; TODO: rename
-        self.conn = Session()
+        # use the scoped_session proxy directly so every worker thread transparently
+        # gets (and cleans up) its own session, instead of all threads sharing the
+        # single session instantiated on the main thread
+        self.Session = scoped_session(session_factory)
+        # this is still named "conn" when it is the session proxy; TODO: rename
+        self.conn = self.Session
+
+        # ids we have already confirmed to exist, so repeated is_*_valid() checks
+        # (every get_* with a filter_term does one) skip the SELECT round trip;
+        # evicted whenever the corresponding rows are removed
+        self.cached_valid_hosts = set()
+        self.cached_valid_users = set()
+        self.cached_valid_groups = set()
+        self.cached_valid_shares = set()
 
     @staticmethod
     def db_schema(db_conn):
         db_conn.execute(
             """CREATE TABLE "hosts" (
             "id" integer PRIMARY KEY,
-            "ip" text,
-            "hostname" text,
-            "domain" text,
+            "ip" text UNIQUE,
+            "hostname" text COLLATE NOCASE,
+            "domain" text COLLATE NOCASE,
             "os" text,
             "dc" boolean,
             "smbv1" boolean,
@@ -66,7 +194,7 @@ class database:
         db_conn.execute(
             """CREATE TABLE "conf_checks" (
             "id" integer PRIMARY KEY,
-            "name" text,
+            "name" text UNIQUE,
             "description" text
             )"""
         )
@@ -79,7 +207,8 @@ class database:
             "secure" boolean,
             "reasons" text,
             FOREIGN KEY(host_id) REFERENCES hosts(id),
-            FOREIGN KEY(check_id) REFERENCES conf_checks(id)
+            FOREIGN KEY(check_id) REFERENCES conf_checks(id),
+            UNIQUE(host_id, check_id)
             )
             """
         )
@@ -87,24 +216,27 @@ class database:
         db_conn.execute(
             """CREATE TABLE "users" (
             "id" integer PRIMARY KEY,
-            "domain" text,
-            "username" text,
+            "domain" text COLLATE NOCASE,
+            "username" text COLLATE NOCASE,
             "password" text,
-            "credtype" text,
+            "credtype" text COLLATE NOCASE,
             "pillaged_from_hostid" integer,
             FOREIGN KEY(pillaged_from_hostid) REFERENCES hosts(id)
             )"""
         )
+        # unique keys the add_credential/add_group upserts conflict on
+        db_conn.execute("""CREATE UNIQUE INDEX "ix_users_domain_username_credtype" ON users(domain, username, credtype)""")
         db_conn.execute(
             """CREATE TABLE "groups" (
             "id" integer PRIMARY KEY,
-            "domain" text,
-            "name" text,
+            "domain" text COLLATE NOCASE,
+            "name" text COLLATE NOCASE,
             "rid" text,
             "member_count_ad" integer,
             "last_query_time" text
             )"""
         )
+        db_conn.execute("""CREATE UNIQUE INDEX "ix_groups_domain_name" ON groups(domain, name)""")
         # This table keeps track of which credential has admin access over which machine and vice-versa
         db_conn.execute(
             """CREATE TABLE "admin_relations" (
@@ -112,7 +244,8 @@ class database:
             "userid" integer,
             "hostid" integer,
             FOREIGN KEY(userid) REFERENCES users(id),
-            FOREIGN KEY(hostid) REFERENCES hosts(id)
+            FOREIGN KEY(hostid) REFERENCES hosts(id),
+            UNIQUE(userid, hostid)
             )"""
         )
         db_conn.execute(
@@ -121,7 +254,8 @@ class database:
             "userid" integer,
             "groupid" integer,
             FOREIGN KEY(userid) REFERENCES users(id),
-            FOREIGN KEY(groupid) REFERENCES groups(id)
+            FOREIGN KEY(groupid) REFERENCES groups(id),
+            UNIQUE(userid, groupid)
             )"""
         )
         db_conn.execute(
@@ -137,6 +271,8 @@ class database:
             UNIQUE(hostid, userid, name)
         )"""
         )
+        # get_users_with_share_access filters on (hostid, name), which this turns into an index seek
+        db_conn.execute("""CREATE INDEX "ix_shares_hostid_name" ON shares(hostid, name)""")
         db_conn.execute(
             """CREATE TABLE "loggedin_relations" (
             "id" integer PRIMARY KEY,
@@ -150,18 +286,18 @@ class database:
             """CREATE TABLE "dpapi_secrets" (
             "id" integer PRIMARY KEY,
             "host" text,
-            "dpapi_type" text,
+            "dpapi_type" text COLLATE NOCASE,
             "windows_user" text,
             "username" text,
             "password" text,
-            "url" text,
+            "url" text COLLATE NOCASE,
             UNIQUE(host, dpapi_type, windows_user, username, password, url)
         )"""
         )
         db_conn.execute(
             """CREATE TABLE "dpapi_backupkey" (
             "id" integer PRIMARY KEY,
-            "domain" text,
+            "domain" text COLLATE NOCASE,
             "pvk" text,
             UNIQUE(domain)
         )"""
@@ -174,43 +310,101 @@ class database:
         #    "hash" text,
         #    FOREIGN KEY(hostid) REFERENCES hosts(id)
         #    )''')
+        db_conn.execute(f"PRAGMA user_version = {DB_SCHEMA_VERSION}")
 
     def reflect_tables(self):
-        with self.db_engine.connect():
-            try:
-                self.HostsTable = Table("hosts", self.metadata, autoload_with=self.db_engine)
-                self.UsersTable = Table("users", self.metadata, autoload_with=self.db_engine)
-                self.GroupsTable = Table("groups", self.metadata, autoload_with=self.db_engine)
-                self.SharesTable = Table("shares", self.metadata, autoload_with=self.db_engine)
-                self.AdminRelationsTable = Table("admin_relations", self.metadata, autoload_with=self.db_engine)
-                self.GroupRelationsTable = Table("group_relations", self.metadata, autoload_with=self.db_engine)
-                self.LoggedinRelationsTable = Table("loggedin_relations", self.metadata, autoload_with=self.db_engine)
-                self.DpapiSecrets = Table("dpapi_secrets", self.metadata, autoload_with=self.db_engine)
-                self.DpapiBackupkey = Table("dpapi_backupkey", self.metadata, autoload_with=self.db_engine)
-                self.ConfChecksTable = Table("conf_checks", self.metadata, autoload_with=self.db_engine)
-                self.ConfChecksResultsTable = Table("conf_checks_results", self.metadata, autoload_with=self.db_engine)
-            except (NoInspectionAvailable, NoSuchTableError):
-                print(
-                    f"""
-                    [-] Error reflecting tables for the {self.protocol} protocol - this means there is a DB schema mismatch
-                    [-] This is probably because a newer version of nxc is being run on an old DB schema
-                    [-] Optionally save the old DB data (`cp {self.db_path} ~/nxc_{self.protocol.lower()}.bak`)
-                    [-] Then remove the {self.protocol} DB (`rm -f {self.db_path}`) and run nxc to initialize the new DB"""
-                )
-                sys.exit()
+        # the table definitions are static, so only the schema version stamp and a
+        # table existence check run here instead of a PRAGMA round trip per table;
+        # the version stamp also catches old databases that have the right tables
+        # but lack the unique indexes/constraints the upserts conflict on
+        with self.db_engine.connect() as conn:
+            schema_version = conn.execute(text("PRAGMA user_version")).scalar()
+            existing_tables = inspect(conn).get_table_names()
+        if schema_version != DB_SCHEMA_VERSION or any(table not in existing_tables for table in self.metadata.tables):
+            print(
+                f"""
+                [-] Error reflecting tables for the {self.protocol} protocol - this means there is a DB schema mismatch
+                [-] This is probably because a newer version of nxc is being run on an old DB schema
+                [-] Optionally save the old DB data (`cp {self.db_path} ~/nxc_{self.protocol.lower()}.bak`)
+                [-] Then remove the {self.protocol} DB (`rm -f {self.db_path}`) and run nxc to initialize the new DB"""
+            )
+            sys.exit()
+
+        self.HostsTable = HostsTable
+        self.UsersTable = UsersTable
+        self.GroupsTable = GroupsTable
+        self.SharesTable = SharesTable
+        self.AdminRelationsTable = AdminRelationsTable
+        self.GroupRelationsTable = GroupRelationsTable
+        self.LoggedinRelationsTable = LoggedinRelationsTable
+        self.DpapiSecrets = DpapiSecrets
+        self.DpapiBackupkey = DpapiBackupkey
+        self.ConfChecksTable = ConfChecksTable
+        self.ConfChecksResultsTable = ConfChecksResultsTable
+
+        # the four read/write permission combinations are fixed, so build their
+        # Select objects once instead of reconstructing them on every call
+        self._shares_by_perm = {}
+        self._share_users_by_perm = {}
+        for mask in range(4):
+            preds = []
+            if mask & 1:
+                preds.append(self.SharesTable.c.read == 1)
+            if mask & 2:
+                preds.append(self.SharesTable.c.write == 1)
+            self._shares_by_perm[mask] = select(self.SharesTable).where(*preds)
+            self._share_users_by_perm[mask] = select(self.SharesTable.c.userid).where(*preds)
+
+    @staticmethod
+    def _perm_mask(permissions):
+        """Map an 'r'/'w' permissions string to the key of the cached share queries."""
+        permissions = permissions.lower()
+        return (("r" in permissions) << 0) | (("w" in permissions) << 1)
+
+    @contextmanager
+    def batch(self):
+        """
+        Group all writes issued inside the block into one SQLite transaction.
+
+        The engine runs in autocommit mode, so every write normally pays its own
+        fsync; wrapping a burst of writes (e.g. everything learned from one host)
+        in an explicit BEGIN/COMMIT reduces that to a single one.
+        """
+        self.conn.execute(text("BEGIN"))
+        try:
+            yield self
+        except Exception:
+            self.conn.execute(text("ROLLBACK"))
+            raise
+        else:
+            self.conn.execute(text("COMMIT"))
 
     def shutdown_db(self):
         try:
-            self.conn.close()
+            self.Session.remove()
         # due to the async nature of nxc, sometimes session state is a bit messy and this will throw:
         # Method 'close()' can't be called here; method '_connection_for_bind()' is already in progress and
         # this would cause an unexpected state change to <SessionTransactionState.CLOSED: 5>
         except IllegalStateChangeError as e:
             nxc_logger.debug(f"Error while closing session db object: {e}")
 
+    @staticmethod
+    def _as_record_id(record_id):
+        """Normalize a filter term to a record id, or None if it can't be one (e.g. a share name)."""
+        try:
+            return int(record_id)
+        except (TypeError, ValueError):
+            return None
+
     def clear_database(self):
-        for table in self.metadata.sorted_tables:
-            self.conn.execute(table.delete())
+        # one transaction (and one fsync) for all the deletes instead of one per table
+        with self.batch():
+            for table in self.metadata.sorted_tables:
+                self.conn.execute(table.delete())
+        self.cached_valid_hosts.clear()
+        self.cached_valid_users.clear()
+        self.cached_valid_groups.clear()
+        self.cached_valid_shares.clear()
 
     # pull/545
     def add_host(
@@ -226,167 +420,87 @@ class database:
         petitpotam=None,
         dc=None,
     ):
-        """Check if this host has already been added to the database, if not, add it in."""
-        hosts = []
-        updated_ids = []
+        """Add this host to the database in a single upsert, only overwriting columns that were passed in."""
+        host = {
+            "ip": ip,
+            "hostname": hostname,
+            "domain": domain,
+            "os": os if os is not None else "",
+            "dc": dc,
+            "smbv1": smbv1,
+            "signing": signing,
+            "spooler": spooler,
+            "zerologon": zerologon,
+            "petitpotam": petitpotam,
+        }
+        nxc_logger.debug(f"Upsert Host: {host}")
 
-        q = select(self.HostsTable).filter(self.HostsTable.c.ip == ip)
-        results = self.conn.execute(q).all()
+        q = Insert(self.HostsTable).values(host)
+        # coalesce(excluded, current) is the SQL version of the old Python-side
+        # "only update column if it is being passed in" merge
+        update_columns = {col.name: func.coalesce(col, self.HostsTable.c[col.name]) for col in q.excluded if col.name not in ("id", "ip")}
+        # os defaults to "" on first insert, so "" must also count as "not passed in"
+        # when merging or a later add_host(os=None) would wipe the stored fingerprint
+        update_columns["os"] = func.coalesce(func.nullif(q.excluded["os"], ""), self.HostsTable.c.os)
+        q = q.on_conflict_do_update(index_elements=["ip"], set_=update_columns).returning(self.HostsTable.c.id)
 
-        # create new host
-        if not results:
-            new_host = {
-                "ip": ip,
-                "hostname": hostname,
-                "domain": domain,
-                "os": os if os is not None else "",
-                "dc": dc,
-                "smbv1": smbv1,
-                "signing": signing,
-                "spooler": spooler,
-                "zerologon": zerologon,
-                "petitpotam": petitpotam,
-            }
-            hosts = [new_host]
-        # update existing hosts data
-        else:
-            for host in results:
-                host_data = host._asdict()
-                # only update column if it is being passed in
-                if ip is not None:
-                    host_data["ip"] = ip
-                if hostname is not None:
-                    host_data["hostname"] = hostname
-                if domain is not None:
-                    host_data["domain"] = domain
-                if os is not None:
-                    host_data["os"] = os
-                if smbv1 is not None:
-                    host_data["smbv1"] = smbv1
-                if signing is not None:
-                    host_data["signing"] = signing
-                if spooler is not None:
-                    host_data["spooler"] = spooler
-                if zerologon is not None:
-                    host_data["zerologon"] = zerologon
-                if petitpotam is not None:
-                    host_data["petitpotam"] = petitpotam
-                if dc is not None:
-                    host_data["dc"] = dc
-                # only add host to be updated if it has changed
-                if host_data not in hosts:
-                    hosts.append(host_data)
-                    updated_ids.append(host_data["id"])
-        nxc_logger.debug(f"Update Hosts: {hosts}")
-
-        # TODO: find a way to abstract this away to a single Upsert call
-        q = Insert(self.HostsTable)  # .returning(self.HostsTable.c.id)
-        update_columns = {col.name: col for col in q.excluded if col.name not in "id"}
-        q = q.on_conflict_do_update(index_elements=self.HostsTable.primary_key, set_=update_columns)
-
-        self.conn.execute(q, hosts)  # .scalar()
-        # we only return updated IDs for now - when RETURNING clause is allowed we can return inserted
-        if updated_ids:
-            nxc_logger.debug(f"add_host() - Host IDs Updated: {updated_ids}")
-            return updated_ids
+        host_id = self.conn.execute(q).scalar()
+        nxc_logger.debug(f"add_host() - Host ID: {host_id}")
+        return [host_id]
 
     def add_credential(self, credtype, domain, username, password, group_id=None, pillaged_from=None):
-        """Check if this credential has already been added to the database, if not add it in."""
-        credentials = []
-        groups = []
-
+        """Add this credential to the database in a single upsert keyed on domain/username/credtype."""
         if (group_id and not self.is_group_valid(group_id)) or (pillaged_from and not self.is_host_valid(pillaged_from)):
             nxc_logger.debug("Invalid group or host")
-            return
+            return None
 
-        q = select(self.UsersTable).filter(
-            func.lower(self.UsersTable.c.domain) == func.lower(domain),
-            func.lower(self.UsersTable.c.username) == func.lower(username),
-            func.lower(self.UsersTable.c.credtype) == func.lower(credtype),
-        )
-        results = self.conn.execute(q).all()
+        credential_data = {
+            "credtype": credtype,
+            "domain": domain,
+            "username": username,
+            "password": password,
+            "pillaged_from_hostid": pillaged_from,
+        }
+        nxc_logger.debug(f"Adding credential: {credential_data}")
 
-        # add new credential
-        if not results:
-            new_cred = {
-                "credtype": credtype,
-                "domain": domain,
-                "username": username,
-                "password": password,
-                "groupid": group_id,
-                "pillaged_from": pillaged_from,
-            }
-            credentials = [new_cred]
-        # update existing cred data
-        else:
-            for creds in results:
-                # this will include the id, so we don't touch it
-                cred_data = creds._asdict()
-                # only update column if it is being passed in
-                if credtype is not None:
-                    cred_data["credtype"] = credtype
-                if domain is not None:
-                    cred_data["domain"] = domain
-                if username is not None:
-                    cred_data["username"] = username
-                if password is not None:
-                    cred_data["password"] = password
-                if group_id is not None:
-                    cred_data["groupid"] = group_id
-                    groups.append({"userid": cred_data["id"], "groupid": group_id})
-                if pillaged_from is not None:
-                    cred_data["pillaged_from"] = pillaged_from
-                # only add cred to be updated if it has changed
-                if cred_data not in credentials:
-                    credentials.append(cred_data)
-
-        # TODO: find a way to abstract this away to a single Upsert call
-        q_users = Insert(self.UsersTable)  # .returning(self.UsersTable.c.id)
-        update_columns_users = {col.name: col for col in q_users.excluded if col.name not in "id"}
-        q_users = q_users.on_conflict_do_update(index_elements=self.UsersTable.primary_key, set_=update_columns_users)
-        nxc_logger.debug(f"Adding credentials: {credentials}")
-
-        self.conn.execute(q_users, credentials)  # .scalar()
-
-        if groups:
-            q_groups = Insert(self.GroupRelationsTable)
-
-            self.conn.execute(q_groups, groups)
+        q = Insert(self.UsersTable).values(credential_data)
+        # coalesce(excluded, current) keeps the stored value for any column not being passed in
+        update_columns = {col.name: func.coalesce(col, self.UsersTable.c[col.name]) for col in q.excluded if col.name != "id"}
+        q = q.on_conflict_do_update(
+            index_elements=["domain", "username", "credtype"],
+            set_=update_columns,
+        ).returning(self.UsersTable.c.id)
+        user_rowid = self.conn.execute(q).scalar()
+
+        if group_id:
+            # UNIQUE(userid, groupid) drops duplicate relations, so no pre-check needed
+            gr_data = {"userid": user_rowid, "groupid": group_id}
+            self.conn.execute(Insert(self.GroupRelationsTable).values(gr_data).on_conflict_do_nothing(index_elements=["userid", "groupid"]))
+
+        nxc_logger.debug(f"add_credential() - Credential ID: {user_rowid}")
+        return user_rowid
 
     def remove_credentials(self, creds_id):
-        """Removes a credential ID from the database"""
-        del_hosts = []
-        for cred_id in creds_id:
-            q = delete(self.UsersTable).filter(self.UsersTable.c.id == cred_id)
-            del_hosts.append(q)
+        """Removes the given credential IDs from the database in one DELETE"""
+        q = delete(self.UsersTable).filter(self.UsersTable.c.id.in_(list(creds_id)))
         self.conn.execute(q)
+        for cred_id in creds_id:
+            self.cached_valid_users.discard(self._as_record_id(cred_id))
 
     def add_admin_user(self, credtype, domain, username, password, host, user_id=None):
-        add_links = []
-
         creds_q = select(self.UsersTable)
-        creds_q = creds_q.filter(self.UsersTable.c.id == user_id) if user_id else creds_q.filter(func.lower(self.UsersTable.c.credtype) == func.lower(credtype), func.lower(self.UsersTable.c.domain) == func.lower(domain), func.lower(self.UsersTable.c.username) == func.lower(username), self.UsersTable.c.password == password)
+        creds_q = creds_q.filter(self.UsersTable.c.id == user_id) if user_id else creds_q.filter(self.UsersTable.c.credtype == credtype, self.UsersTable.c.domain == domain, self.UsersTable.c.username == username, self.UsersTable.c.password == password)
         users = self.conn.execute(creds_q)
         hosts = self.get_hosts(host)
 
         if users and hosts:
-            for user, host in zip(users, hosts):
-                user_id = user[0]
-                host_id = host[0]
-                link = {"userid": user_id, "hostid": host_id}
-                admin_relations_select = select(self.AdminRelationsTable).filter(
-                    self.AdminRelationsTable.c.userid == user_id,
-                    self.AdminRelationsTable.c.hostid == host_id,
-                )
-                links = self.conn.execute(admin_relations_select).all()
+            add_links = [{"userid": user[0], "hostid": host[0]} for user, host in zip(users, hosts)]
 
-                if not links:
-                    add_links.append(link)
-
-        admin_relations_insert = Insert(self.AdminRelationsTable)
-
-        if add_links:
-            self.conn.execute(admin_relations_insert, add_links)
+            if add_links:
+                # one statement for all links; UNIQUE(userid, hostid) deduplicates for us,
+                # so no SELECT round trip per link is needed beforehand
+                q = Insert(self.AdminRelationsTable).values(add_links).on_conflict_do_nothing(index_elements=["userid", "hostid"])
+                self.conn.execute(q)
 
     def get_admin_relations(self, user_id=None, host_id=None):
         if user_id:
@@ -401,21 +515,18 @@ class database:
     def remove_admin_relation(self, user_ids=None, host_ids=None):
         q = delete(self.AdminRelationsTable)
         if user_ids:
-            for user_id in user_ids:
-                q = q.filter(self.AdminRelationsTable.c.userid == user_id)
+            q = q.filter(self.AdminRelationsTable.c.userid.in_(list(user_ids)))
         elif host_ids:
-            for host_id in host_ids:
-                q = q.filter(self.AdminRelationsTable.c.hostid == host_id)
+            q = q.filter(self.AdminRelationsTable.c.hostid.in_(list(host_ids)))
         self.conn.execute(q)
 
     def is_credential_valid(self, credential_id):
         """Check if this credential ID is valid."""
-        q = select(self.UsersTable).filter(
+        q = select(self.UsersTable.c.id).filter(
             self.UsersTable.c.id == credential_id,
-            self.UsersTable.c.password is not None,
-        )
-        results = self.conn.execute(q).all()
-        return len(results) > 0
+            self.UsersTable.c.password.is_not(None),
+        ).limit(1)
+        return self.conn.execute(q).first() is not None
 
     def get_credentials(self, filter_term=None, cred_type=None):
         """Return credentials from the database."""
@@ -426,8 +537,8 @@ class database:
             q = select(self.UsersTable).filter(self.UsersTable.c.credtype == cred_type)
         # if we're filtering by username
         elif filter_term and filter_term != "":
-            like_term = func.lower(f"%{filter_term}%")
-            q = select(self.UsersTable).filter(func.lower(self.UsersTable.c.username).like(like_term))
+            like_term = f"%{filter_term}%".lower()
+            q = select(self.UsersTable).filter(self.UsersTable.c.username.like(like_term))
         # otherwise return all credentials
         else:
             q = select(self.UsersTable)
@@ -455,9 +566,17 @@ class database:
 
     def is_host_valid(self, host_id):
         """Check if this host ID is valid."""
-        q = select(self.HostsTable).filter(self.HostsTable.c.id == host_id)
-        results = self.conn.execute(q).all()
-        return len(results) > 0
+        host_id = self._as_record_id(host_id)
+        if host_id is None:
+            return False
+        if host_id in self.cached_valid_hosts:
+            return True
+        # existence check only, so fetch a single id instead of the whole row
+        q = select(self.HostsTable.c.id).filter(self.HostsTable.c.id == host_id).limit(1)
+        valid = self.conn.execute(q).first() is not None
+        if valid:
+            self.cached_valid_hosts.add(host_id)
+        return valid
 
     def get_hosts(self, filter_term=None, domain=None):
         """Return hosts from the database."""
@@ -473,7 +592,7 @@ class database:
         elif filter_term == "dc":
             q = q.filter(self.HostsTable.c.dc is True)
             if domain:
-                q = q.filter(func.lower(self.HostsTable.c.domain) == func.lower(domain))
+                q = q.filter(self.HostsTable.c.domain == domain)
         elif filter_term == "signing":
             # generally we want hosts that are vulnerable, so signing disabled
             q = q.filter(self.HostsTable.c.signing is False)
@@ -485,88 +604,54 @@ class database:
             q = q.filter(self.HostsTable.c.petitpotam is True)
         elif filter_term is not None and filter_term.startswith("domain"):
             domain = filter_term.split()[1]
-            like_term = func.lower(f"%{domain}%")
+            like_term = f"%{domain}%".lower()
             q = q.filter(self.HostsTable.c.domain.like(like_term))
         # if we're filtering by ip/hostname
         elif filter_term and filter_term != "":
-            like_term = func.lower(f"%{filter_term}%")
-            q = q.filter(self.HostsTable.c.ip.like(like_term) | func.lower(self.HostsTable.c.hostname).like(like_term))
+            like_term = f"%{filter_term}%".lower()
+            q = q.filter(self.HostsTable.c.ip.like(like_term) | self.HostsTable.c.hostname.like(like_term))
         results = self.conn.execute(q).all()
         nxc_logger.debug(f"smb hosts() - results: {results}")
         return results
 
     def is_group_valid(self, group_id):
         """Check if this group ID is valid."""
-        q = select(self.GroupsTable).filter(self.GroupsTable.c.id == group_id)
+        group_id = self._as_record_id(group_id)
+        if group_id is None:
+            return False
+        if group_id in self.cached_valid_groups:
+            return True
+        q = select(self.GroupsTable.c.id).filter(self.GroupsTable.c.id == group_id).limit(1)
         results = self.conn.execute(q).first()
 
         valid = bool(results)
         nxc_logger.debug(f"is_group_valid(groupID={group_id}) => {valid}")
+        if valid:
+            self.cached_valid_groups.add(group_id)
 
         return valid
 
     def add_group(self, domain, name, rid=None, member_count_ad=None):
-        results = self.get_groups(group_name=name, group_domain=domain)
-
-        groups = []
-        updated_ids = []
-
         group_data = {
             "domain": domain,
             "name": name,
             "rid": rid,
             "member_count_ad": member_count_ad,
-            "last_query_time": None,
+            "last_query_time": datetime.now().isoformat() if member_count_ad is not None else None,
         }
+        nxc_logger.debug(f"Upsert Group: {group_data}")
 
-        if not results:
-            if member_count_ad is not None:
-                group_data["member_count_ad"] = member_count_ad
-                today = datetime.now()
-                iso_date = today.isoformat()
-                group_data["last_query_time"] = iso_date
-            groups = [group_data]
-
-            # insert the group and get the returned id right away, this can be refactored when we can use RETURNING
-            q = Insert(self.GroupsTable)
-
-            self.conn.execute(q, groups)
-            new_group_data = self.get_groups(group_name=group_data["name"], group_domain=group_data["domain"])
-            returned_id = [new_group_data[0].id]
-            nxc_logger.debug(f"Inserted group with ID: {returned_id[0]}")
-            return returned_id
-        else:
-            for group in results:
-                g_data = group._asdict()
-                if domain is not None:
-                    g_data["domain"] = domain
-                if name is not None:
-                    g_data["name"] = name
-                if rid is not None:
-                    g_data["rid"] = rid
-                if member_count_ad is not None:
-                    g_data["member_count_ad"] = member_count_ad
-                    today = datetime.now()
-                    iso_date = today.isoformat()
-                    g_data["last_query_time"] = iso_date
-                # only add it to the upsert query if it's changed to save query execution time
-                if g_data not in groups:
-                    groups.append(g_data)
-                    updated_ids.append(g_data["id"])
-
-        nxc_logger.debug(f"Update Groups: {groups}")
-
-        # TODO: find a way to abstract this away to a single Upsert call
-        q = Insert(self.GroupsTable)  # .returning(self.GroupsTable.c.id)
-        update_columns = {col.name: col for col in q.excluded if col.name not in "id"}
-        q = q.on_conflict_do_update(index_elements=self.GroupsTable.primary_key, set_=update_columns)
-
-        self.conn.execute(q, groups)
-        # TODO: always return a list and fix code references to not expect a single integer
-        #
-        if updated_ids:
-            nxc_logger.debug(f"Updated groups with IDs: {updated_ids}")
-        return updated_ids
+        q = Insert(self.GroupsTable).values(group_data)
+        # coalesce(excluded, current) keeps the stored value for any column not being passed in
+        update_columns = {col.name: func.coalesce(col, self.GroupsTable.c[col.name]) for col in q.excluded if col.name != "id"}
+        q = q.on_conflict_do_update(
+            index_elements=["domain", "name"],
+            set_=update_columns,
+        ).returning(self.GroupsTable.c.id)
+
+        returned_id = [self.conn.execute(q).scalar()]
+        nxc_logger.debug(f"add_group() - Group ID: {returned_id[0]}")
+        return returned_id
 
     def get_groups(self, filter_term=None, group_name=None, group_domain=None):
         """Return groups from the database"""
@@ -577,11 +662,11 @@ class database:
             return [results]
         elif group_name and group_domain:
             q = select(self.GroupsTable).filter(
-                func.lower(self.GroupsTable.c.name) == func.lower(group_name),
-                func.lower(self.GroupsTable.c.domain) == func.lower(group_domain),
+                self.GroupsTable.c.name == group_name,
+                self.GroupsTable.c.domain == group_domain,
             )
         elif filter_term and filter_term != "":
-            like_term = func.lower(f"%{filter_term}%")
+            like_term = f"%{filter_term}%".lower()
             q = select(self.GroupsTable).filter(self.GroupsTable.c.name.like(like_term))
         else:
             q = select(self.GroupsTable).filter()
@@ -614,9 +699,16 @@ class database:
 
     def is_user_valid(self, user_id):
         """Check if this User ID is valid."""
-        q = select(self.UsersTable).filter(self.UsersTable.c.id == user_id)
-        results = self.conn.execute(q).all()
-        return len(results) > 0
+        user_id = self._as_record_id(user_id)
+        if user_id is None:
+            return False
+        if user_id in self.cached_valid_users:
+            return True
+        q = select(self.UsersTable.c.id).filter(self.UsersTable.c.id == user_id).limit(1)
+        valid = self.conn.execute(q).first() is not None
+        if valid:
+            self.cached_valid_users.add(user_id)
+        return valid
 
     def get_users(self, filter_term=None):
         q = select(self.UsersTable)
@@ -625,14 +717,14 @@ class database:
             q = q.filter(self.UsersTable.c.id == filter_term)
         # if we're filtering by username
         elif filter_term and filter_term != "":
-            like_term = func.lower(f"%{filter_term}%")
-            q = q.filter(func.lower(self.UsersTable.c.username).like(like_term))
+            like_term = f"%{filter_term}%".lower()
+            q = q.filter(self.UsersTable.c.username.like(like_term))
         return self.conn.execute(q).all()
 
     def get_user(self, domain, username):
         q = select(self.UsersTable).filter(
-            func.lower(self.UsersTable.c.domain) == func.lower(domain),
-            func.lower(self.UsersTable.c.username) == func.lower(username),
+            self.UsersTable.c.domain == domain,
+            self.UsersTable.c.username == username,
         )
         return self.conn.execute(q).all()
 
@@ -641,11 +733,18 @@ class database:
 
     def is_share_valid(self, share_id):
         """Check if this share ID is valid."""
-        q = select(self.SharesTable).filter(self.SharesTable.c.id == share_id)
-        results = self.conn.execute(q).all()
-
-        nxc_logger.debug(f"is_share_valid(shareID={share_id}) => {len(results) > 0}")
-        return len(results) > 0
+        share_id = self._as_record_id(share_id)
+        if share_id is None:
+            return False
+        if share_id in self.cached_valid_shares:
+            return True
+        q = select(self.SharesTable.c.id).filter(self.SharesTable.c.id == share_id).limit(1)
+        valid = self.conn.execute(q).first() is not None
+
+        nxc_logger.debug(f"is_share_valid(shareID={share_id}) => {valid}")
+        if valid:
+            self.cached_valid_shares.add(share_id)
+        return valid
 
     def add_share(self, host_id, user_id, name, remark, read, write):
         share_data = {
@@ -661,34 +760,30 @@ class database:
             share_data,
         )  # .scalar_one()
 
+    def add_shares(self, shares):
+        """Add a batch of shares (dicts of share columns) in a single INSERT; duplicates are dropped by UNIQUE(hostid, userid, name)."""
+        if not shares:
+            return
+        self.conn.execute(Insert(self.SharesTable).values(shares).on_conflict_do_nothing())
+
     def get_shares(self, filter_term=None):
         if self.is_share_valid(filter_term):
             q = select(self.SharesTable).filter(self.SharesTable.c.id == filter_term)
         elif filter_term:
-            like_term = func.lower(f"%{filter_term}%")
+            like_term = f"%{filter_term}%".lower()
             q = select(self.SharesTable).filter(self.SharesTable.c.name.like(like_term))
         else:
             q = select(self.SharesTable)
         return self.conn.execute(q).all()
 
     def get_shares_by_access(self, permissions, share_id=None):
-        permissions = permissions.lower()
-        q = select(self.SharesTable)
+        q = self._shares_by_perm[self._perm_mask(permissions)]
         if share_id:
-            q = q.filter(self.SharesTable.c.id == share_id)
-        if "r" in permissions:
-            q = q.filter(self.SharesTable.c.read == 1)
-        if "w" in permissions:
-            q = q.filter(self.SharesTable.c.write == 1)
+            q = q.where(self.SharesTable.c.id == share_id)
         return self.conn.execute(q).all()
 
     def get_users_with_share_access(self, host_id, share_name, permissions):
-        permissions = permissions.lower()
-        q = select(self.SharesTable.c.userid).filter(self.SharesTable.c.name == share_name, self.SharesTable.c.hostid == host_id)
-        if "r" in permissions:
-            q = q.filter(self.SharesTable.c.read == 1)
-        if "w" in permissions:
-            q = q.filter(self.SharesTable.c.write == 1)
+        q = self._share_users_by_perm[self._perm_mask(permissions)].where(self.SharesTable.c.name == share_name, self.SharesTable.c.hostid == host_id)
         return self.conn.execute(q).all()
 
 
@@ -698,20 +793,15 @@ class database:
         :domain is the domain fqdn
         :pvk is the domain backupkey
         """
-        q = select(self.DpapiBackupkey).filter(func.lower(self.DpapiBackupkey.c.domain) == func.lower(domain))
-        results = self.conn.execute(q).all()
-
-        if not len(results):
-            pvk_encoded = base64.b64encode(pvk)
-            backup_key = {"domain": domain, "pvk": pvk_encoded}
-            try:
-                # TODO: find a way to abstract this away to a single Upsert call
-                q = Insert(self.DpapiBackupkey)  # .returning(self.DpapiBackupkey.c.id)
-
-                self.conn.execute(q, [backup_key])  # .scalar()
-                nxc_logger.debug(f"add_domain_backupkey(domain={domain}, pvk={pvk_encoded})")
-            except Exception as e:
-                nxc_logger.debug(f"Issue while inserting DPAPI Backup Key: {e}")
+        pvk_encoded = base64.b64encode(pvk)
+        backup_key = {"domain": domain, "pvk": pvk_encoded}
+        try:
+            # UNIQUE(domain) keeps the first key, so no pre-SELECT round trip is needed
+            q = Insert(self.DpapiBackupkey).values(backup_key).on_conflict_do_nothing(index_elements=["domain"])
+            self.conn.execute(q)
+            nxc_logger.debug(f"add_domain_backupkey(domain={domain}, pvk={pvk_encoded})")
+        except Exception as e:
+            nxc_logger.debug(f"Issue while inserting DPAPI Backup Key: {e}")
 
     def get_domain_backupkey(self, domain: Optional[str] = None):
         """
@@ -720,7 +810,7 @@ class database:
         """
         q = select(self.DpapiBackupkey)
         if domain is not None:
-            q = q.filter(func.lower(self.DpapiBackupkey.c.domain) == func.lower(domain))
+            q = q.filter(self.DpapiBackupkey.c.domain == domain)
         results = self.conn.execute(q).all()
 
         nxc_logger.debug(f"get_domain_backupkey(domain={domain}) => {results}")
@@ -734,7 +824,7 @@ class database:
         Check if this group ID is valid.
         :dpapi_secret_id is a primary id
         """
-        q = select(self.DpapiSecrets).filter(func.lower(self.DpapiSecrets.c.id) == dpapi_secret_id)
+        q = select(self.DpapiSecrets.c.id).filter(self.DpapiSecrets.c.id == dpapi_secret_id).limit(1)
         results = self.conn.execute(q).first()
         valid = results is not None
         nxc_logger.debug(f"is_dpapi_secret_valid(groupID={dpapi_secret_id}) => {valid}")
@@ -788,41 +878,40 @@ class database:
             # all() returns a list, so we keep the return format the same so consumers don't have to guess
             return [results]
         elif dpapi_type:
-            q = q.filter(func.lower(self.DpapiSecrets.c.dpapi_type) == func.lower(dpapi_type))
+            q = q.filter(self.DpapiSecrets.c.dpapi_type == dpapi_type)
         elif windows_user:
-            like_term = func.lower(f"%{windows_user}%")
-            q = q.filter(func.lower(self.DpapiSecrets.c.windows_user).like(like_term))
+            like_term = f"%{windows_user}%".lower()
+            q = q.filter(self.DpapiSecrets.c.windows_user.like(like_term))
         elif username:
-            like_term = func.lower(f"%{username}%")
-            q = q.filter(func.lower(self.DpapiSecrets.c.windows_user).like(like_term))
+            like_term = f"%{username}%".lower()
+            q = q.filter(self.DpapiSecrets.c.windows_user.like(like_term))
         elif url:
-            q = q.filter(func.lower(self.DpapiSecrets.c.url) == func.lower(url))
+            q = q.filter(self.DpapiSecrets.c.url == url)
         results = self.conn.execute(q).all()
 
         nxc_logger.debug(f"get_dpapi_secrets(filter_term={filter_term}, host={host}, dpapi_type={dpapi_type}, windows_user={windows_user}, username={username}, url={url}) => {results}")
         return results
 
     def add_loggedin_relation(self, user_id, host_id):
-        relation_query = select(self.LoggedinRelationsTable).filter(
+        relation_query = select(self.LoggedinRelationsTable.c.id).filter(
             self.LoggedinRelationsTable.c.userid == user_id,
             self.LoggedinRelationsTable.c.hostid == host_id,
         )
-        results = self.conn.execute(relation_query).all()
+        results = self.conn.execute(relation_query).first()
 
         # only add one if one doesn't already exist
-        if not results:
-            relation = {"userid": user_id, "hostid": host_id}
-            try:
-                nxc_logger.debug(f"Inserting loggedin_relations: {relation}")
-                # TODO: find a way to abstract this away to a single Upsert call
-                q = Insert(self.LoggedinRelationsTable)  # .returning(self.LoggedinRelationsTable.c.id)
-
-                self.conn.execute(q, [relation])  # .scalar()
-                inserted_id_results = self.get_loggedin_relations(user_id, host_id)
-                nxc_logger.debug(f"Checking if relation was added: {inserted_id_results}")
-                return inserted_id_results[0].id
-            except Exception as e:
-                nxc_logger.debug(f"Error inserting LoggedinRelation: {e}")
+        if results:
+            return results.id
+        relation = {"userid": user_id, "hostid": host_id}
+        try:
+            nxc_logger.debug(f"Inserting loggedin_relations: {relation}")
+            # RETURNING gives us the new id without a follow-up SELECT
+            q = Insert(self.LoggedinRelationsTable).values(relation).returning(self.LoggedinRelationsTable.c.id)
+            inserted_id = self.conn.execute(q).scalar()
+            nxc_logger.debug(f"Inserted loggedin_relations with id: {inserted_id}")
+            return inserted_id
+        except Exception as e:
+            nxc_logger.debug(f"Error inserting LoggedinRelation: {e}")
 
     def get_loggedin_relations(self, user_id=None, host_id=None):
         q = select(self.LoggedinRelationsTable)  # .returning(self.LoggedinRelationsTable.c.id)
@@ -848,60 +937,27 @@ class database:
         q = select(self.ConfChecksResultsTable)
         return self.conn.execute(q).all()
 
-    def insert_data(self, table, select_results=None, **new_row):
+    def insert_data(self, table, index_elements, **new_row):
         """
-        Insert a new row in the given table.
-        Basically it's just a more generic version of add_host
+        Upsert a row into the given table in a single statement.
+        Basically it's just a more generic version of add_host: the columns in
+        index_elements decide whether an existing row is updated instead, and
+        columns passed as None keep their stored value.
         """
-        if select_results is None:
-            select_results = []
-        results = []
-        updated_ids = []
-
-        # Create new row
-        if not select_results:
-            results = [new_row]
-        # Update existing row data
-        else:
-            for row in select_results:
-                row_data = row._asdict()
-                for column, value in new_row.items():
-                    row_data[column] = value
-
-                # Only add data to be updated if it has changed
-                if row_data not in results:
-                    results.append(row_data)
-                    updated_ids.append(row_data["id"])
-
-        nxc_logger.debug(f"Update data: {results}")
-        # TODO: find a way to abstract this away to a single Upsert call
-        q = Insert(table)  # .returning(table.c.id)
-        update_column = {col.name: col for col in q.excluded if col.name not in "id"}
-        q = q.on_conflict_do_update(index_elements=table.primary_key, set_=update_column)
-        self.conn.execute(q, results)  # .scalar()
-        # we only return updated IDs for now - when RETURNING clause is allowed we can return inserted
-        return updated_ids
+        nxc_logger.debug(f"Upsert data: {new_row} into table: {table.name}")
+        q = Insert(table).values(new_row)
+        update_columns = {col.name: func.coalesce(col, table.c[col.name]) for col in q.excluded if col.name != "id"}
+        q = q.on_conflict_do_update(index_elements=index_elements, set_=update_columns).returning(table.c.id)
+        return [self.conn.execute(q).scalar()]
 
     def add_check(self, name, description):
-        """Check if this check item has already been added to the database, if not, add it in."""
-        q = select(self.ConfChecksTable).filter(self.ConfChecksTable.c.name == name)
-        select_results = self.conn.execute(q).all()
-        context = locals()
-        new_row = {column: context[column] for column in ("name", "description")}
-        updated_ids = self.insert_data(self.ConfChecksTable, select_results, **new_row)
-
-        if updated_ids:
-            nxc_logger.debug(f"add_check() - Checks IDs Updated: {updated_ids}")
-            return updated_ids
+        """Add this check item to the database, or update its description if it already exists."""
+        returned_ids = self.insert_data(self.ConfChecksTable, ["name"], name=name, description=description)
+        nxc_logger.debug(f"add_check() - Check ID: {returned_ids[0]}")
+        return returned_ids
 
     def add_check_result(self, host_id, check_id, secure, reasons):
-        """Check if this check result has already been added to the database, if not, add it in."""
-        q = select(self.ConfChecksResultsTable).filter(self.ConfChecksResultsTable.c.host_id == host_id, self.ConfChecksResultsTable.c.check_id == check_id)
-        select_results = self.conn.execute(q).all()
-        context = locals()
-        new_row = {column: context[column] for column in ("host_id", "check_id", "secure", "reasons")}
-        updated_ids = self.insert_data(self.ConfChecksResultsTable, select_results, **new_row)
-
-        if updated_ids:
-            nxc_logger.debug(f"add_check_result() - Check Results IDs Updated: {updated_ids}")
-            return updated_ids
+        """Add this check result to the database, or update the existing result for this host and check."""
+        returned_ids = self.insert_data(self.ConfChecksResultsTable, ["host_id", "check_id"], host_id=host_id, check_id=check_id, secure=secure, reasons=reasons)
+        nxc_logger.debug(f"add_check_result() - Check Result ID: {returned_ids[0]}")
+        return returned_ids
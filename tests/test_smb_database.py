@@ -123,6 +123,39 @@ def test_update_host(db, sess):
     assert host.dc is False
 
 
+def test_update_host_only_passed_columns(db):
+    db.add_host(
+        "127.0.0.1",
+        "localhost",
+        "TEST.DEV",
+        "Windows Testing 2023",
+        False,
+        True,
+        True,
+        True,
+        False,
+        False,
+    )
+    # columns passed as None (including os) must keep their stored value
+    db.add_host(
+        "127.0.0.1",
+        None,
+        None,
+        None,
+        None,
+        None,
+    )
+    inserted_host = db.get_hosts()
+    assert len(inserted_host) == 1
+    host = inserted_host[0]
+    assert host.hostname == "localhost"
+    assert host.domain == "TEST.DEV"
+    assert host.os == "Windows Testing 2023"
+    assert host.smbv1 is False
+    assert host.signing is True
+    assert host.spooler is True
+
+
 def test_add_credential():
     pass
 